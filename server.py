@@ -1,27 +1,50 @@
 import os
 import json
 import re
+import time
+import struct
+import threading
+import queue
+import asyncio
+import hashlib
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict
-
+from typing import Optional, List, Dict, Tuple, Union
+
+import aiohttp
+import anyio.to_thread
+import aiosmtplib
+import msgpack
+import numpy as np
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from openai import OpenAI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from openai import AsyncOpenAI, OpenAI
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-from math import sqrt
+from urllib.parse import quote, quote_plus, urljoin, urlparse
 
-import smtplib
 from email.message import EmailMessage
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from functools import lru_cache, partial
 
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from zoneinfo import ZoneInfo
 
+try:
+    import faiss  # по избор: бърз top-k при големи индекси
+except ImportError:
+    faiss = None
+
 # =========================
 # Logging конфигурация
 # =========================
@@ -29,6 +52,50 @@ from zoneinfo import ZoneInfo
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("chatvlt")
 
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Стандартният QueueHandler.prepare() форматира съобщението още в нишката, която логва.
+    Тук записът влиза в опашката непроменен, а %-форматирането и писането стават
+    в handler-ите на root в нишката на QueueListener. Безопасно е, защото опашката
+    е в същия процес, а аргументите ни са неизменяеми (низове, числа, изключения).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_log_records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_handler = _DeferredQueueHandler(_log_records)
+_log_listener: Optional[QueueListener] = None
+
+
+def _start_log_listener() -> None:
+    """
+    Вика се при startup, за да вземе handler-ите на root такива, каквито са след
+    конфигурацията на uvicorn (--log-config). Дотогава, и след _stop_log_listener,
+    chatvlt логва директно през root. Handler-и, добавени към root по-късно,
+    не получават записите на chatvlt.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    _log_listener = QueueListener(_log_records, *logging.getLogger().handlers, respect_handler_level=True)
+    _log_listener.start()
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+
+
+def _stop_log_listener() -> None:
+    global _log_listener
+    if _log_listener is None:
+        return
+    logger.removeHandler(_log_handler)
+    logger.propagate = True
+    _log_listener.stop()
+    _log_listener = None
+
+
 # =========================
 # OpenAI клиент
 # =========================
@@ -38,6 +105,8 @@ if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY environment variable is not set.")
 
 client = OpenAI(api_key=OPENAI_API_KEY)
+# Async клиент за /chat, за да не блокираме event loop-а докато стриймваме отговора.
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 # =========================
 # Google Calendar конфигурация
@@ -46,13 +115,28 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 GCAL_SCOPES = ["https://www.googleapis.com/auth/calendar"]
 GCAL_CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID")  # "primary" или "vvtcamp@gmail.com"
 BUSINESS_TIMEZONE = os.getenv("BUSINESS_TIMEZONE", "Europe/Sofia")
+UTC = timezone.utc
+_BIZ_TZ = ZoneInfo(BUSINESS_TIMEZONE)  # фиксира се при стартиране
+GCAL_API_BASE = "https://www.googleapis.com/calendar/v3"
+
+_gcal_credentials = None
+_http_session: Optional[aiohttp.ClientSession] = None
+
 
+def _utc_now_iso() -> str:
+    # Секундите стигат за логове и имейли; по-кратко от isoformat() с микросекунди.
+    return datetime.now(UTC).isoformat(timespec="seconds")
 
-def get_gcal_service():
+
+def get_gcal_credentials():
     """
-    Създава Google Calendar service от service account JSON.
+    Връща (кеширани) service account credentials от GOOGLE_SERVICE_ACCOUNT_JSON.
     Ако няма конфигурация, връща None и само логва предупреждение.
     """
+    global _gcal_credentials
+    if _gcal_credentials is not None:
+        return _gcal_credentials
+
     json_str = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     if not json_str:
         logger.warning("[GCAL] GOOGLE_SERVICE_ACCOUNT_JSON is not set. Calendar integration disabled.")
@@ -60,14 +144,43 @@ def get_gcal_service():
 
     try:
         info = json.loads(json_str)
-        creds = service_account.Credentials.from_service_account_info(info, scopes=GCAL_SCOPES)
-        service = build("calendar", "v3", credentials=creds)
-        return service
+        _gcal_credentials = service_account.Credentials.from_service_account_info(info, scopes=GCAL_SCOPES)
+        return _gcal_credentials
     except Exception as e:
-        logger.error(f"[GCAL] Failed to create service account credentials: {e}")
+        logger.error("[GCAL] Failed to create service account credentials: %s", e)
         return None
 
 
+async def get_gcal_access_token() -> Optional[str]:
+    """
+    Връща валиден access token за Calendar REST API.
+    Токенът се опреснява само когато е изтекъл.
+    """
+    creds = get_gcal_credentials()
+    if creds is None:
+        return None
+
+    if not creds.valid:
+        try:
+            await run_in_threadpool(creds.refresh, GoogleAuthRequest())
+        except Exception as e:
+            logger.error("[GCAL] Failed to refresh access token: %s", e)
+            return None
+
+    return creds.token
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Споделена aiohttp сесия (connection pool) за външните HTTP извиквания.
+    Създава се при startup и се затваря при shutdown на приложението.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+    return _http_session
+
+
 def parse_iso_utc(dt_str: str) -> Optional[datetime]:
     """
     Приема ISO низ (с или без Z) и връща timezone-aware datetime в UTC.
@@ -80,15 +193,15 @@ def parse_iso_utc(dt_str: str) -> Optional[datetime]:
         dt = datetime.fromisoformat(dt_str)
 
         if dt.tzinfo is not None:
-            return dt.astimezone(timezone.utc)
+            return dt.astimezone(UTC)
 
-        return dt.replace(tzinfo=timezone.utc)
+        return dt.replace(tzinfo=UTC)
     except Exception as e:
-        logger.error(f"[GCAL] Failed to parse appointment_time_utc '{dt_str}': {e}")
+        logger.error("[GCAL] Failed to parse ISO datetime '%s': %s", dt_str, e)
         return None
 
 
-def create_calendar_event_from_appointment(record: Dict[str, object]) -> None:
+async def create_calendar_event_from_appointment(record: Dict[str, object]) -> None:
     """
     Създава събитие в Google Calendar от appointment запис.
     Използва appointment_time_utc, ако е подадено; иначе fallback към +1 час от сега.
@@ -97,19 +210,13 @@ def create_calendar_event_from_appointment(record: Dict[str, object]) -> None:
         logger.warning("[GCAL] GOOGLE_CALENDAR_ID is not set. Skipping calendar event.")
         return
 
-    service = get_gcal_service()
-    if service is None:
+    token = await get_gcal_access_token()
+    if token is None:
         return
 
     name = record.get("name") or "Unknown"
     company = record.get("company") or ""
-    email = record.get("email") or ""
-    phone = record.get("phone") or ""
-    location = record.get("location") or ""
-    project_description = record.get("project_description") or ""
-    language = record.get("language") or ""
-    business_id = record.get("business_id") or ""
-    timestamp_utc = record.get("timestamp_utc") or datetime.utcnow().isoformat() + "Z"
+    timestamp_utc = record.get("timestamp_utc") or _utc_now_iso()
     appointment_time_text = record.get("appointment_time_text") or ""
     appointment_time_utc = record.get("appointment_time_utc") or ""
 
@@ -118,49 +225,28 @@ def create_calendar_event_from_appointment(record: Dict[str, object]) -> None:
     else:
         summary = f"VLT DATA – {name}"
 
-    description_lines = [
-        "New appointment request from ChatVLT.",
-        "",
-        f"Name: {name}",
-        f"Company: {company}",
-        f"Email: {email}",
-        f"Phone: {phone}",
-        f"Location: {location}",
-        "",
-        "Project description / Reason for appointment:",
-        project_description,
-        "",
-    ]
-
-    if appointment_time_text:
-        description_lines.append(f"Requested time (human text): {appointment_time_text}")
-    if appointment_time_utc:
-        description_lines.append(f"Requested time (UTC ISO): {appointment_time_utc}")
-
-    description_lines.extend(
-        [
-            "",
-            f"Client language: {language}",
-            f"Business ID: {business_id}",
-            f"Created at (UTC): {timestamp_utc}",
-        ]
+    description = _CALENDAR_DESCRIPTION.format_map(
+        _template_fields(
+            record,
+            name=name,
+            timestamp_utc=timestamp_utc,
+            requested_time=_requested_time_lines(appointment_time_text, appointment_time_utc),
+        )
     )
 
-    description = "\n".join(description_lines)
-
     start_dt = None
     if appointment_time_utc:
         start_dt = parse_iso_utc(appointment_time_utc)
 
     if start_dt is None:
-        start_dt = datetime.utcnow().replace(tzinfo=timezone.utc) + timedelta(hours=1)
+        start_dt = datetime.now(UTC) + timedelta(hours=1)
 
     end_dt = start_dt + timedelta(hours=1)
 
     if start_dt.tzinfo is None:
-        start_dt = start_dt.replace(tzinfo=timezone.utc)
+        start_dt = start_dt.replace(tzinfo=UTC)
     if end_dt.tzinfo is None:
-        end_dt = end_dt.replace(tzinfo=timezone.utc)
+        end_dt = end_dt.replace(tzinfo=UTC)
 
     event_body = {
         "summary": summary,
@@ -176,153 +262,165 @@ def create_calendar_event_from_appointment(record: Dict[str, object]) -> None:
     }
 
     try:
-        event = service.events().insert(calendarId=GCAL_CALENDAR_ID, body=event_body).execute()
-        logger.info(f"[GCAL] Event created: {event.get('id')} for appointment {name}")
+        async with get_http_session().post(
+            f"{GCAL_API_BASE}/calendars/{quote(GCAL_CALENDAR_ID, safe='')}/events",
+            json=event_body,
+            headers={"Authorization": f"Bearer {token}"},
+        ) as resp:
+            resp.raise_for_status()
+            event = await resp.json()
+        logger.info("[GCAL] Event created: %s for appointment %s", event.get("id"), name)
+        # Новото събитие заема слот – следващото питане за свободни часове трябва да го види.
+        _free_windows_cache.clear()
     except Exception as e:
-        logger.error(f"[GCAL] Failed to create calendar event: {e}")
+        logger.error("[GCAL] Failed to create calendar event: %s", e)
 
 
 # ===== Нови функции: четене на календар и свободни прозорци =====
 
-def get_calendar_events(days: int = 7) -> List[Dict[str, datetime]]:
+async def get_calendar_events(days: int = 7) -> Tuple[List[int], List[int]]:
     """
-    Връща списък от събития за следващите 'days' дни:
-    [{ 'start': datetime, 'end': datetime, 'summary': str }]
-    Всички времена са в BUSINESS_TIMEZONE.
+    Връща заетите интервали за следващите 'days' дни чрез freebusy заявка
+    като два паралелни списъка (starts, ends) с epoch секунди.
     """
     if not GCAL_CALENDAR_ID:
         logger.warning("[GCAL] GOOGLE_CALENDAR_ID is not set. Skipping events fetch.")
-        return []
+        return [], []
 
-    service = get_gcal_service()
-    if service is None:
-        return []
+    token = await get_gcal_access_token()
+    if token is None:
+        return [], []
 
-    now_utc = datetime.now(timezone.utc)
+    now_utc = datetime.now(UTC)
     time_min = now_utc.isoformat()
     time_max = (now_utc + timedelta(days=days)).isoformat()
 
     try:
-        events_result = (
-            service.events()
-            .list(
-                calendarId=GCAL_CALENDAR_ID,
-                timeMin=time_min,
-                timeMax=time_max,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
-        )
-        items = events_result.get("items", [])
+        async with get_http_session().post(
+            f"{GCAL_API_BASE}/freeBusy",
+            json={
+                "timeMin": time_min,
+                "timeMax": time_max,
+                "items": [{"id": GCAL_CALENDAR_ID}],
+            },
+            headers={"Authorization": f"Bearer {token}"},
+        ) as resp:
+            resp.raise_for_status()
+            freebusy_result = await resp.json()
+        busy = freebusy_result.get("calendars", {}).get(GCAL_CALENDAR_ID, {}).get("busy", [])
     except Exception as e:
-        logger.error(f"[GCAL] Failed to list events: {e}")
-        return []
+        logger.error("[GCAL] Failed to query free/busy: %s", e)
+        return [], []
 
-    tz = ZoneInfo(BUSINESS_TIMEZONE)
-    events: List[Dict[str, datetime]] = []
+    starts: List[int] = []
+    ends: List[int] = []
 
-    for ev in items:
-        start_raw = ev.get("start", {}).get("dateTime") or ev.get("start", {}).get("date")
-        end_raw = ev.get("end", {}).get("dateTime") or ev.get("end", {}).get("date")
-        if not start_raw or not end_raw:
+    for interval in busy:
+        start_dt = parse_iso_utc(interval.get("start", ""))
+        end_dt = parse_iso_utc(interval.get("end", ""))
+        if start_dt is None or end_dt is None:
             continue
 
-        try:
-            if "T" not in start_raw:
-                start_dt = datetime.fromisoformat(start_raw).replace(tzinfo=tz)
-                end_dt = datetime.fromisoformat(end_raw).replace(tzinfo=tz)
-            else:
-                start_dt = datetime.fromisoformat(start_raw)
-                end_dt = datetime.fromisoformat(end_raw)
-                if start_dt.tzinfo is None:
-                    start_dt = start_dt.replace(tzinfo=timezone.utc)
-                if end_dt.tzinfo is None:
-                    end_dt = end_dt.replace(tzinfo=timezone.utc)
-                start_dt = start_dt.astimezone(tz)
-                end_dt = end_dt.astimezone(tz)
-        except Exception:
-            continue
-
-        events.append(
-            {
-                "start": start_dt,
-                "end": end_dt,
-                "summary": ev.get("summary", ""),
-            }
-        )
+        starts.append(int(start_dt.timestamp()))
+        ends.append(int(end_dt.timestamp()))
 
-    return events
+    return starts, ends
 
 
-def compute_free_windows(days: int = 5) -> List[Dict[str, datetime]]:
+async def compute_free_windows(days: int = 5) -> List[Dict[str, datetime]]:
     """
     Изчислява свободни прозорци за следващите 'days' дни
     в работно време 09:00–17:00 в BUSINESS_TIMEZONE.
     Връща списък от {'start': dt, 'end': dt}.
     """
-    tz = ZoneInfo(BUSINESS_TIMEZONE)
-    now_tz = datetime.now(timezone.utc).astimezone(tz)
+    tz = _BIZ_TZ
+    now_tz = datetime.now(UTC).astimezone(tz)
 
-    busy_events = get_calendar_events(days)
+    starts, ends = await get_calendar_events(days)
+    # Сортираме веднъж; обхождането по дни после е само с int сравнения.
+    order = sorted(range(len(starts)), key=starts.__getitem__)
     free_windows: List[Dict[str, datetime]] = []
 
     WORK_START_HOUR = 9
     WORK_END_HOUR = 17
 
+    now_epoch = int(now_tz.timestamp())
+
     for i in range(days):
         day = (now_tz + timedelta(days=i)).date()
-        day_start = datetime(day.year, day.month, day.day, WORK_START_HOUR, 0, tzinfo=tz)
-        day_end = datetime(day.year, day.month, day.day, WORK_END_HOUR, 0, tzinfo=tz)
+        day_start = int(datetime(day.year, day.month, day.day, WORK_START_HOUR, 0, tzinfo=tz).timestamp())
+        day_end = int(datetime(day.year, day.month, day.day, WORK_END_HOUR, 0, tzinfo=tz).timestamp())
 
-        if day_end <= now_tz:
+        if day_end <= now_epoch:
             continue
 
-        if i == 0 and now_tz > day_start:
-            day_start = now_tz
+        if i == 0 and now_epoch > day_start:
+            day_start = now_epoch
 
-        todays_busy = []
-        for ev in busy_events:
-            s = ev["start"]
-            e = ev["end"]
+        current = day_start
+        for j in order:
+            s = starts[j]
+            e = ends[j]
             if e <= day_start or s >= day_end:
                 continue
-            if s < day_start:
-                s = day_start
-            if e > day_end:
-                e = day_end
-            todays_busy.append((s, e))
-
-        todays_busy.sort(key=lambda x: x[0])
-
-        current = day_start
-        for s, e in todays_busy:
             if s > current:
-                free_windows.append({"start": current, "end": s})
+                free_windows.append(
+                    {
+                        "start": datetime.fromtimestamp(current, tz),
+                        "end": datetime.fromtimestamp(s, tz),
+                    }
+                )
             if e > current:
-                current = e
+                current = min(e, day_end)
 
         if current < day_end:
-            free_windows.append({"start": current, "end": day_end})
+            free_windows.append(
+                {
+                    "start": datetime.fromtimestamp(current, tz),
+                    "end": datetime.fromtimestamp(day_end, tz),
+                }
+            )
 
     return free_windows
 
 
-def get_free_windows_text(days: int = 5) -> Optional[str]:
+FREE_WINDOWS_TTL = 60  # секунди
+
+_free_windows_cache: TTLCache = TTLCache(maxsize=8, ttl=FREE_WINDOWS_TTL)
+_free_windows_lock = asyncio.Lock()
+
+
+async def get_free_windows_text(days: int = 5) -> Optional[str]:
     """
     Връща текстово описание на свободните интервали за следващите дни,
-    което се подава към модела.
+    което се подава към модела. Резултатът се пази FREE_WINDOWS_TTL секунди;
+    при празен кеш само една заявка пита календара, останалите я изчакват.
     """
+    key = ("free_windows", days)
+    text = _free_windows_cache.get(key)
+    if text is not None:
+        return text
+
+    async with _free_windows_lock:
+        text = _free_windows_cache.get(key)
+        if text is None:
+            text = await _free_windows_text(days)
+            if text is not None:
+                _free_windows_cache[key] = text
+    return text
+
+
+async def _free_windows_text(days: int) -> Optional[str]:
     try:
-        free_windows = compute_free_windows(days)
+        free_windows = await compute_free_windows(days)
     except Exception as e:
-        logger.error(f"[GCAL] Failed to compute free windows: {e}")
+        logger.error("[GCAL] Failed to compute free windows: %s", e)
         return None
 
     if not free_windows:
         return "There are no free time windows in the calendar in the next few days."
 
-    tz = ZoneInfo(BUSINESS_TIMEZONE)
+    tz = _BIZ_TZ
     lines: List[str] = []
     current_date = None
 
@@ -589,142 +687,488 @@ BUSINESSES = {
     }
 }
 
+_DEFAULT_BIZ = BUSINESSES["vlt_data"]
+
+
+def _biz(business_id: str) -> Dict[str, str]:
+    """Конфигурацията на бизнеса; за непознат business_id – тази по подразбиране."""
+    return BUSINESSES.get(business_id) or _DEFAULT_BIZ
+
+
 APPOINTMENT_MARKER = "##APPOINTMENT##"
 CONTACT_MARKER = "##CONTACT_MESSAGE##"
 SEARCH_MARKER = "##SEARCH_LINK##"
 
+_MARKERS = (APPOINTMENT_MARKER, CONTACT_MARKER, SEARCH_MARKER)
+_MAX_MARKER_LEN = max(len(m) for m in _MARKERS)
+# Всички маркери с едно търсене по отговора.
+_MARK_RE = re.compile("|".join(map(re.escape, _MARKERS)))
+
+_DECODER = json.JSONDecoder()
+
+
+def _decode_marker_json(json_str: str) -> Optional[Dict[str, object]]:
+    """
+    Парсва първия JSON обект след маркер. Текстът преди "{" и след обекта се игнорира.
+    """
+    start = json_str.find("{")
+    if start < 0:
+        return None
+    try:
+        data, _ = _DECODER.raw_decode(json_str, start)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+_WS_RE = re.compile(r"\s+")
+
 
 def _clean_text(text: str, max_length: int = 4000) -> str:
     if not text:
         return ""
-    cleaned = " ".join(text.split())
-    return cleaned[:max_length]
+    return _WS_RE.sub(" ", text).strip()[:max_length]
 
 
-def _is_same_domain(base_url: str, other_url: str) -> bool:
+_EXT_BLACKLIST = (
+    ".jpg", ".jpeg", ".png", ".gif", ".svg", ".ico", ".pdf", ".zip", ".rar",
+    ".mp4", ".webm", ".mp3", ".css", ".js", ".woff2",
+)
+
+
+def _is_same_domain(base_netloc: str, other_url: str) -> bool:
     try:
-        base = urlparse(base_url)
-        other = urlparse(other_url)
-        return base.netloc == other.netloc
+        return urlparse(other_url).netloc == base_netloc
     except Exception:
         return False
 
 
+CRAWL_WORKERS = 16
+MAX_PAGE_BYTES = 2_000_000
+
+# Обща сесия за crawler-а: keep-alive връзки към сайта (по една на нишка) и кратки retry-и.
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = "ChatVLT-Bot/1.0"
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_maxsize=CRAWL_WORKERS, max_retries=Retry(total=2, backoff_factor=0.2)),
+)
+_SESSION.mount(
+    "http://",
+    HTTPAdapter(pool_maxsize=CRAWL_WORKERS, max_retries=Retry(total=2, backoff_factor=0.2)),
+)
+
+
+def _fetch_page(session: requests.Session, url: str) -> Tuple[Optional[Dict[str, str]], List[str]]:
+    """
+    Сваля и парсва една страница (изпълнява се в нишка от crawl_site).
+    Връща (страница или None, абсолютните линкове от нея).
+    """
+    try:
+        # stream=True: проверяваме Content-Type преди да свалим тялото и го четем до лимит.
+        with session.get(url, timeout=10, stream=True) as resp:
+            if "text/html" not in resp.headers.get("Content-Type", ""):
+                return None, []
+            body = resp.raw.read(MAX_PAGE_BYTES, decode_content=True)
+        soup = BeautifulSoup(body, "lxml")
+
+        title = soup.title.string.strip() if soup.title and soup.title.string else url
+
+        for tag in soup(["script", "style", "noscript"]):
+            tag.decompose()
+        text = soup.get_text(separator=" ", strip=True)
+        text = _clean_text(text)
+
+        page = {"url": url, "title": title, "text": text} if text else None
+
+        links: List[str] = []
+        for a in soup.find_all("a", href=True):
+            href = a["href"].strip()
+            if not href:
+                continue
+            full = urljoin(url, href)
+            if "#" in full:
+                full = full.split("#", 1)[0]
+            links.append(full)
+
+        return page, links
+    except Exception:
+        return None, []
+
+
 def crawl_site(business_id: str) -> List[Dict[str, str]]:
-    biz = BUSINESSES.get(business_id, BUSINESSES["vlt_data"])
+    biz = _biz(business_id)
     base_url = biz.get("site_url")
     if not base_url:
         return []
 
     max_pages = int(os.getenv("MAX_PAGES_PER_SITE", "40"))
+    base_netloc = urlparse(base_url).netloc
 
     visited = set()
-    to_visit = [base_url]
+    to_visit = deque([base_url])
+    queued = {base_url}
     pages: List[Dict[str, str]] = []
 
-    headers = {"User-Agent": "ChatVLT-Bot/1.0"}
-
-    while to_visit and len(pages) < max_pages:
-        url = to_visit.pop(0)
-        if url in visited:
-            continue
-        visited.add(url)
-
-        try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            if "text/html" not in resp.headers.get("Content-Type", ""):
-                continue
-            soup = BeautifulSoup(resp.text, "html.parser")
-
-            title = soup.title.string.strip() if soup.title and soup.title.string else url
-
-            for tag in soup(["script", "style", "noscript"]):
-                tag.decompose()
-            text = soup.get_text(separator=" ", strip=True)
-            text = _clean_text(text)
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+        fetch = partial(_fetch_page, _SESSION)
 
-            if text:
-                pages.append({"url": url, "title": title, "text": text})
-
-            for a in soup.find_all("a", href=True):
-                href = a["href"].strip()
-                if not href:
-                    continue
-                full = urljoin(url, href)
-                if "#" in full:
-                    full = full.split("#", 1)[0]
-                if full in visited or full in to_visit:
+        while to_visit and len(pages) < max_pages:
+            # BFS на вълни: сваляме паралелно до CRAWL_WORKERS страници,
+            # а резултатите обработваме в основната нишка, в реда на опашката.
+            batch: List[str] = []
+            while to_visit and len(batch) < min(CRAWL_WORKERS, max_pages - len(pages)):
+                url = to_visit.popleft()
+                if url in visited:
                     continue
-                if not _is_same_domain(base_url, full):
-                    continue
-                if any(
-                    full.lower().endswith(ext)
-                    for ext in [".jpg", ".jpeg", ".png", ".gif", ".pdf", ".zip", ".rar"]
-                ):
-                    continue
-                to_visit.append(full)
-        except Exception:
-            continue
+                visited.add(url)
+                batch.append(url)
+
+            for page, links in executor.map(fetch, batch):
+                if page and len(pages) < max_pages:
+                    pages.append(page)
+
+                for full in links:
+                    if full in visited or full in queued:
+                        continue
+                    if not _is_same_domain(base_netloc, full):
+                        continue
+                    if full.lower().endswith(_EXT_BLACKLIST):
+                        continue
+                    to_visit.append(full)
+                    queued.add(full)
 
     return pages
 
 
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBED_BATCH_SIZE = 96
+
+
 def embed_text(text: str) -> List[float]:
     if not text:
         return []
     try:
         resp = client.embeddings.create(
-            model="text-embedding-3-large",
+            model=EMBEDDING_MODEL,
             input=[text],
         )
         return resp.data[0].embedding
     except Exception as e:
-        logger.error(f"[EMBED] Error creating embedding: {e}")
+        logger.error("[EMBED] Error creating embedding: %s", e)
         return []
 
 
-def build_site_index(business_id: str) -> List[Dict[str, object]]:
-    index_filename = f"site_index_{business_id}.json"
-    if os.path.exists(index_filename):
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """
+    Embedding-и за много текстове – по една заявка на EMBED_BATCH_SIZE входа.
+    Резултатът е в същия ред като texts; празни текстове и неуспешни групи дават [].
+    """
+    result: List[List[float]] = [[] for _ in texts]
+    positions = [i for i, t in enumerate(texts) if t]
+
+    for start in range(0, len(positions), EMBED_BATCH_SIZE):
+        batch = positions[start:start + EMBED_BATCH_SIZE]
         try:
-            with open(index_filename, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    return data
+            resp = client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=[texts[i] for i in batch],
+            )
         except Exception as e:
-            logger.error(f"[INDEX] Error reading index file: {e}")
+            logger.error("[EMBED] Error creating embeddings batch: %s", e)
+            continue
+        for item in resp.data:
+            result[batch[item.index]] = item.embedding
 
-    pages = crawl_site(business_id)
-    index: List[Dict[str, object]] = []
-    for p in pages:
-        emb = embed_text(p["text"])
-        index.append(
+    return result
+
+
+def _normalized_matrix(vectors: Union[List[List[float]], np.ndarray]) -> np.ndarray:
+    """
+    Подрежда embedding-ите в (N, D) float32 матрица с L2-нормирани редове,
+    така че косинусовото сходство да е просто M @ q.
+    """
+    if len(vectors) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    matrix = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def _quantize_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    int8 квантизация с отделен мащаб за всеки ред: row ≈ q_row * scale.
+    Индексът заема 4 пъти по-малко памет и диск от float32.
+    """
+    if matrix.size == 0:
+        return np.zeros(matrix.shape, dtype=np.int8), np.zeros(matrix.shape[0], dtype=np.float32)
+
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+# (пасажи, int8 матрица с нормирани и квантизирани embedding-и, мащаб на всеки ред)
+_SiteIndex = Tuple[List[Dict[str, object]], np.ndarray, np.ndarray]
+
+
+def _index_paths(business_id: str) -> Tuple[str, str]:
+    return f"site_index_{business_id}.npz", f"site_index_{business_id}.meta.json"
+
+
+def _load_site_index(business_id: str) -> Optional[_SiteIndex]:
+    emb_path, meta_path = _index_paths(business_id)
+    if not os.path.exists(emb_path) or not os.path.exists(meta_path):
+        return None
+
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            pages = json.load(f)
+        with np.load(emb_path) as data:
+            matrix = data["embeddings"]
+            scales = data["scales"] if "scales" in data.files else None
+            normalized = bool(data["normalized"]) if "normalized" in data.files else False
+    except Exception as e:
+        logger.error("[INDEX] Error reading index file: %s", e)
+        return None
+
+    if not isinstance(pages, list) or len(pages) != matrix.shape[0]:
+        logger.error("[INDEX] Index metadata does not match embeddings, rebuilding.")
+        return None
+
+    if scales is None:
+        # По-стар float32 индекс – нормираме (ако трябва) и квантизираме при зареждане.
+        if not normalized:
+            matrix = _normalized_matrix(matrix)
+        matrix, scales = _quantize_rows(matrix)
+
+    return pages, matrix, scales
+
+
+def _save_site_index(business_id: str, pages: List[Dict[str, object]], matrix: np.ndarray, scales: np.ndarray) -> None:
+    emb_path, meta_path = _index_paths(business_id)
+    try:
+        np.savez(emb_path, embeddings=matrix, scales=scales, normalized=np.array(True))
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(pages, f, ensure_ascii=False)
+    except Exception as e:
+        logger.error("[INDEX] Error writing index file: %s", e)
+
+
+SNIPPET_CHARS = 800
+# След колко часа индексът се счита за остарял и се обновява (0 = никога, само при липса).
+SITE_INDEX_MAX_AGE_HOURS = float(os.getenv("SITE_INDEX_MAX_AGE_HOURS", "0") or 0)
+CHUNK_WORDS = 300  # ~400 токена
+CHUNK_OVERLAP_WORDS = 40  # ~50 токена
+
+
+def _chunk_text(text: str) -> List[str]:
+    """
+    Разделя текста на пасажи от CHUNK_WORDS думи с припокриване CHUNK_OVERLAP_WORDS,
+    за да има всеки embedding по-тясна тема от цялата страница.
+    """
+    words = text.split()
+    if not words:
+        return []
+
+    step = CHUNK_WORDS - CHUNK_OVERLAP_WORDS
+    chunks: List[str] = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + CHUNK_WORDS]))
+        if start + CHUNK_WORDS >= len(words):
+            break
+    return chunks
+
+
+# business_id -> (mtime на .npz файла, индекс, FAISS индекс или None)
+_INDEX_CACHE: Dict[str, Tuple[Optional[float], _SiteIndex, object]] = {}
+# build_site_index се вика от нишките на threadpool-а – една нишка строи/зарежда индекса,
+# другите чакат готовия резултат вместо да обхождат сайта паралелно.
+_INDEX_LOCK = threading.Lock()
+
+
+def _index_mtime(business_id: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(_index_paths(business_id)[0])
+    except OSError:
+        return None
+
+
+def _build_faiss_index(index: _SiteIndex):
+    """
+    FAISS индекс по вътрешно произведение (= косинус при нормирани вектори) с 8-битово
+    скаларно квантизиране. Връща None, ако faiss не е инсталиран или индексът е празен.
+    """
+    if faiss is None:
+        return None
+
+    _, matrix, scales = index
+    if matrix.shape[0] == 0:
+        return None
+
+    vectors = np.ascontiguousarray(matrix.astype(np.float32) * scales[:, None])
+    faiss_index = faiss.IndexScalarQuantizer(
+        vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+    faiss_index.train(vectors)
+    faiss_index.add(vectors)
+    return faiss_index
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _index_is_stale(business_id: str) -> bool:
+    if SITE_INDEX_MAX_AGE_HOURS <= 0:
+        return False
+    mtime = _index_mtime(business_id)
+    return mtime is not None and time.time() - mtime > SITE_INDEX_MAX_AGE_HOURS * 3600
+
+
+def _rebuild_site_index(business_id: str, previous: Optional[_SiteIndex]) -> _SiteIndex:
+    """
+    Обхожда сайта наново и праща за embedding само пасажите, чийто текст се е променил.
+    Редовете за непроменени пасажи (същият text_hash) се взимат наготово от стария индекс.
+    """
+    chunks = [
+        {"url": p["url"], "title": p["title"], "chunk_id": i, "text": chunk}
+        for p in crawl_site(business_id)
+        for i, chunk in enumerate(_chunk_text(p["text"]))
+    ]
+    if not chunks and previous is not None and previous[0]:
+        # Сайтът не отговаря – пазим стария индекс и отлагаме следващия опит с един период.
+        logger.warning("[INDEX] %s: crawl returned nothing, keeping the old index", business_id)
+        os.utime(_index_paths(business_id)[0])
+        return previous
+
+    hashes = [_text_hash(c["text"]) for c in chunks]
+
+    reusable: Dict[str, int] = {}
+    if previous is not None:
+        for row, item in enumerate(previous[0]):
+            text_hash = item.get("text_hash")
+            if text_hash:
+                reusable.setdefault(text_hash, row)
+
+    missing = [i for i, h in enumerate(hashes) if h not in reusable]
+    embeddings = embed_texts([chunks[i]["text"] for i in missing])
+    embedded = [i for i, emb in zip(missing, embeddings) if emb]
+    new_matrix, new_scales = _quantize_rows(_normalized_matrix([emb for emb in embeddings if emb]))
+    new_rows = {i: row for row, i in enumerate(embedded)}
+    logger.info(
+        "[INDEX] %s: %s chunks, %s reused, %s embedded",
+        business_id, len(chunks), len(chunks) - len(missing), len(embedded),
+    )
+
+    pages = []
+    rows: List[np.ndarray] = []
+    row_scales: List[float] = []
+    for i, (chunk, text_hash) in enumerate(zip(chunks, hashes)):
+        if text_hash in reusable:
+            row = reusable[text_hash]
+            rows.append(previous[1][row])
+            row_scales.append(previous[2][row])
+        elif i in new_rows:
+            rows.append(new_matrix[new_rows[i]])
+            row_scales.append(new_scales[new_rows[i]])
+        else:
+            continue
+        # Пълният текст трябва само за embedding-а; в индекса пазим само откъса за контекста.
+        pages.append(
             {
-                "url": p["url"],
-                "title": p["title"],
-                "text": p["text"],
-                "embedding": emb,
+                "url": chunk["url"],
+                "title": chunk["title"],
+                "chunk_id": chunk["chunk_id"],
+                "text_hash": text_hash,
+                "snippet": chunk["text"][:SNIPPET_CHARS],
             }
         )
 
-    try:
-        with open(index_filename, "w", encoding="utf-8") as f:
-            json.dump(index, f, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f"[INDEX] Error writing index file: {e}")
+    if rows:
+        matrix = np.stack(rows).astype(np.int8)
+        scales = np.asarray(row_scales, dtype=np.float32)
+    else:
+        matrix, scales = _quantize_rows(_normalized_matrix([]))
+    _save_site_index(business_id, pages, matrix, scales)
+    return pages, matrix, scales
+
 
-    return index
+def build_site_index(business_id: str) -> Tuple[List[Dict[str, object]], np.ndarray, np.ndarray, object]:
+    """
+    Връща (пасажи, int8 матрица с нормирани embedding-и, мащаби, FAISS индекс или None),
+    като ред i от матрицата съответства на пасаж i. Четирите са от един и същи запис
+    в кеша, така че FAISS id-тата винаги сочат в същия списък с пасажи.
+    Всяка страница се разбива на няколко припокриващи се пасажа (виж _chunk_text).
+    Индексът се пази като .npz + .meta.json и се кешира в паметта, докато файлът
+    не бъде презаписан. Ако е зададен SITE_INDEX_MAX_AGE_HOURS, остарелият индекс
+    се обновява инкрементално (виж _rebuild_site_index).
+    """
+    # business_id идва от клиента – непознатите ползват индекса по подразбиране, иначе всеки
+    # нов id би обходил сайта отново и би останал в _INDEX_CACHE до рестарт.
+    if business_id not in BUSINESSES:
+        business_id = "vlt_data"
 
+    cached = _INDEX_CACHE.get(business_id)
+    if cached is not None and not _index_is_stale(business_id) and cached[0] == _index_mtime(business_id):
+        return (*cached[1], cached[2])
+
+    with _INDEX_LOCK:
+        stale = _index_is_stale(business_id)
+        cached = _INDEX_CACHE.get(business_id)
+        if cached is not None and not stale and cached[0] == _index_mtime(business_id):
+            return (*cached[1], cached[2])
+
+        previous = _load_site_index(business_id)
+        index = previous if not stale else None
+        if index is None:
+            index = _rebuild_site_index(business_id, previous)
+
+        faiss_index = _build_faiss_index(index)
+        _INDEX_CACHE[business_id] = (_index_mtime(business_id), index, faiss_index)
+        return (*index, faiss_index)
+
+
+QUERY_EMBED_CACHE_SIZE = 1024
+_QUERY_EMBED_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_QUERY_EMBED_LOCK = threading.Lock()
+
+
+def embed_query(query: str) -> Optional[np.ndarray]:
+    """
+    Нормиран embedding на потребителска заявка с LRU кеш, за да не питаме OpenAI
+    отново за вече виждани въпроси. Ключът е заявката с малки букви и слети интервали.
+    """
+    key = " ".join(query.lower().split())
+    if not key:
+        return None
+
+    with _QUERY_EMBED_LOCK:
+        cached = _QUERY_EMBED_CACHE.get(key)
+        if cached is not None:
+            _QUERY_EMBED_CACHE.move_to_end(key)
+            return cached
+
+    emb = embed_text(key)
+    if not emb:
+        return None
+
+    vec = np.asarray(emb, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    if norm == 0:
+        return None
+    vec /= norm
+    vec.setflags(write=False)
 
-def _cosine_similarity(a: List[float], b: List[float]) -> float:
-    if not a or not b or len(a) != len(b):
-        return 0.0
-    dot = sum(x * y for x, y in zip(a, b))
-    na = sqrt(sum(x * x for x in a))
-    nb = sqrt(sum(y * y for y in b))
-    if na == 0 or nb == 0:
-        return 0.0
-    return dot / (na * nb)
+    with _QUERY_EMBED_LOCK:
+        _QUERY_EMBED_CACHE[key] = vec
+        if len(_QUERY_EMBED_CACHE) > QUERY_EMBED_CACHE_SIZE:
+            _QUERY_EMBED_CACHE.popitem(last=False)
+    return vec
 
 
 def find_relevant_pages(business_id: str, query: str, top_k: int = 3) -> List[Dict[str, str]]:
@@ -732,47 +1176,41 @@ def find_relevant_pages(business_id: str, query: str, top_k: int = 3) -> List[Di
     if not query:
         return []
 
-    index = build_site_index(business_id)
-    if not index:
+    items, matrix, scales, faiss_index = build_site_index(business_id)
+    if not items:
         return []
 
-    q_emb = embed_text(query)
-    if not q_emb:
+    q = embed_query(query)
+    if q is None or q.shape[0] != matrix.shape[1]:
         return []
 
-    scored = []
-    for item in index:
-        emb = item.get("embedding") or []
-        sim = _cosine_similarity(q_emb, emb)
-        if sim > 0:
-            scored.append((sim, item))
-
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top_items = [it for _, it in scored[:top_k]]
+    k = min(top_k, len(items))
+    if faiss_index is not None:
+        _, found_ids = faiss_index.search(np.ascontiguousarray(q[None, :]), k)
+        top_items = [items[i] for i in found_ids[0] if i >= 0]
+    else:
+        q_quantized, q_scale = _quantize_rows(q[None, :])
+        # int8 · int8 с натрупване в int32 (3072 * 127² се събира), после обратно към косинус.
+        sims = np.einsum("ij,j->i", matrix, q_quantized[0], dtype=np.int32) * scales * q_scale[0]
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        top_items = [items[i] for i in top]
     return [
         {
             "url": it["url"],
             "title": it.get("title", it["url"]),
-            "text": it.get("text", ""),
+            "snippet": it.get("snippet") or it.get("text", "")[:SNIPPET_CHARS],
         }
         for it in top_items
     ]
 
 
-def build_site_context_message(business_id: str, user_query: str) -> Optional[str]:
-    pages = find_relevant_pages(business_id, user_query, top_k=3)
-    if not pages:
-        return None
-
-    parts = []
-    for p in pages:
-        snippet = p["text"][:800]
-        parts.append(
-            f"URL: {p['url']}\nTITLE: {p['title']}\nCONTENT SNIPPET:\n{snippet}"
-        )
-
-    joined = "\n\n---\n\n".join(parts)
-    biz_name = BUSINESSES.get(business_id, BUSINESSES["vlt_data"])["name"]
+@lru_cache(maxsize=16)
+def _site_context_prefix(business_id: str) -> str:
+    """
+    Неизменната част от контекста със сайта – зависи само от business_id.
+    """
+    biz_name = _biz(business_id)["name"]
     return (
         "The following is trusted content taken directly from the official website "
         f"of {biz_name}."
@@ -783,12 +1221,44 @@ def build_site_context_message(business_id: str, user_query: str) -> Optional[st
         "\n- descriptions of pages, sections and policies"
         "\n\nALWAYS include clickable links (the URLs below) in your answer when helpful."
         "\n\n"
-        f"{joined}"
     )
 
 
+def _site_context_query_part(business_id: str, user_query: str) -> Optional[str]:
+    # Индексът е по пасажи – взимаме повече кандидати и оставяме най-добрия за всеки URL.
+    candidates = find_relevant_pages(business_id, user_query, top_k=9)
+    if not candidates:
+        return None
+
+    pages: List[Dict[str, str]] = []
+    seen_urls = set()
+    for p in candidates:
+        if p["url"] in seen_urls:
+            continue
+        seen_urls.add(p["url"])
+        pages.append(p)
+        if len(pages) == 3:
+            break
+
+    parts = []
+    for p in pages:
+        snippet = p["snippet"]
+        parts.append(
+            f"URL: {p['url']}\nTITLE: {p['title']}\nCONTENT SNIPPET:\n{snippet}"
+        )
+    return "\n\n---\n\n".join(parts)
+
+
+def build_site_context_message(business_id: str, user_query: str) -> Optional[str]:
+    joined = _site_context_query_part(business_id, user_query)
+    if not joined:
+        return None
+    return _site_context_prefix(business_id) + joined
+
+
+@lru_cache(maxsize=16)
 def build_system_prompt(business_id: str) -> str:
-    biz = BUSINESSES.get(business_id, BUSINESSES["vlt_data"])
+    biz = _biz(business_id)
 
     return f"""
 You are ChatVLT – an AI assistant for the company {biz['name']}.
@@ -998,55 +1468,441 @@ TASK:
 """
 
 
+# =========================
+# Шаблони за имейли и календар
+# =========================
+
+_CALENDAR_DESCRIPTION = """New appointment request from ChatVLT.
+
+Name: {name}
+Company: {company}
+Email: {email}
+Phone: {phone}
+Location: {location}
+
+Project description / Reason for appointment:
+{project_description}
+
+{requested_time}
+Client language: {language}
+Business ID: {business_id}
+Created at (UTC): {timestamp_utc}"""
+
+_APPT_BODY_BG = """Имате нова заявка за среща от ChatVLT.
+
+Име: {name}
+Фирма: {company}
+Email: {email}
+Телефон: {phone}
+Локация: {location}
+
+Описание на проекта / причина за среща:
+{project_description}
+
+{requested_time}
+Език на клиента / Client language: {language}
+Business ID: {business_id}
+
+Време (UTC): {timestamp_utc}"""
+
+_APPT_BODY_EN = """You have a new appointment request from ChatVLT.
+
+Name: {name}
+Company: {company}
+Email: {email}
+Phone: {phone}
+Location: {location}
+
+Project / appointment description:
+{project_description}
+
+{requested_time}
+Език на клиента / Client language: {language}
+Business ID: {business_id}
+
+Време (UTC): {timestamp_utc}"""
+
+_APPT_CLIENT_BODY_BG = """Здравейте, {name},
+
+Вашата заявка за среща е получена успешно.
+
+Обобщение:
+- Име: {name}
+- Фирма: {company}
+- Локация: {location}
+
+Описание на проекта / причина за срещата:
+{project_description}
+
+{preferred_time}
+Екипът на VLT DATA SOLUTIONS ще прегледа заявката и ще се свърже с вас за окончателно потвърждение на часа.
+
+Поздрави,
+VLT DATA SOLUTIONS"""
+
+_APPT_CLIENT_BODY_EN = """Hello {name},
+
+Your appointment request has been received successfully.
+
+Summary:
+- Name: {name}
+- Company: {company}
+- Location: {location}
+
+Project / appointment description:
+{project_description}
+
+{preferred_time}
+The VLT DATA SOLUTIONS team will review your request and contact you to confirm the exact time.
+
+Best regards,
+VLT DATA SOLUTIONS"""
+
+_CONTACT_BODY_BG = """Имате ново контактно съобщение от ChatVLT.
+
+Име: {name}
+Email: {email}
+Телефон: {phone}
+
+Тема: {subject}
+
+Съобщение:
+{message}
+
+Език на клиента: {language}
+Business ID: {business_id}
+
+Време (UTC): {timestamp_utc}"""
+
+_CONTACT_BODY_EN = """You have a new contact message from ChatVLT.
+
+Name: {name}
+Email: {email}
+Phone: {phone}
+
+Subject: {subject}
+
+Message:
+{message}
+
+Client language: {language}
+Business ID: {business_id}
+
+Time (UTC): {timestamp_utc}"""
+
+
+# (език, вид, получател) -> (тема, тяло); темата също се попълва през format_map.
+_TEMPLATES: Dict[Tuple[str, str, str], Tuple[str, str]] = {
+    ("bg", "appt", "company"): ("Нова заявка за среща от ChatVLT ({business_id})", _APPT_BODY_BG),
+    ("en", "appt", "company"): ("New appointment request from ChatVLT ({business_id})", _APPT_BODY_EN),
+    ("bg", "appt", "client"): ("Потвърждение за заявка за среща с VLT DATA SOLUTIONS", _APPT_CLIENT_BODY_BG),
+    ("en", "appt", "client"): ("Appointment request received – VLT DATA SOLUTIONS", _APPT_CLIENT_BODY_EN),
+    ("bg", "contact", "company"): ("Ново съобщение от ChatVLT ({business_id})", _CONTACT_BODY_BG),
+    ("en", "contact", "company"): ("New contact message from ChatVLT ({business_id})", _CONTACT_BODY_EN),
+}
+
+_PREFERRED_TIME_LABELS = {"bg": "Предпочитан час", "en": "Preferred time"}
+
+
+class _SafeDict(dict):
+    """dict за str.format_map – липсващите полета стават празен низ."""
+
+    def __missing__(self, key: str) -> str:
+        return ""
+
+
+def _template_fields(data: Dict[str, object], **extra: object) -> _SafeDict:
+    # Празните / None стойности се третират като липсващи, както при `data.get(...) or ""`.
+    fields = _SafeDict({k: v for k, v in data.items() if v})
+    fields.update(extra)
+    return fields
+
+
+def _template_lang(data: Dict[str, object]) -> str:
+    return "bg" if str(data.get("language") or "").lower().startswith("bg") else "en"
+
+
+def _render_email(lang: str, kind: str, recipient: str, fields: _SafeDict) -> Tuple[str, str]:
+    subject, body = _TEMPLATES[(lang, kind, recipient)]
+    return subject.format_map(fields), body.format_map(fields)
+
+
+def _requested_time_lines(time_text: Optional[str], time_utc: Optional[str]) -> str:
+    lines = ""
+    if time_text:
+        lines += f"Requested time (human text): {time_text}\n"
+    if time_utc:
+        lines += f"Requested time (UTC ISO): {time_utc}\n"
+    return lines
+
+
 # =========================
 # Email helper
 # =========================
 
-def send_email(subject: str, body: str, to_email: str) -> None:
+# None в опашката е сигнал към _email_worker да изпрати натрупаното и да спре.
+_email_queue: "asyncio.Queue[Optional[EmailMessage]]" = asyncio.Queue()
+_email_worker_task: Optional[asyncio.Task] = None
+# Една дълготрайна SMTP връзка за всички имейли; достъпът е сериализиран с _smtp_lock.
+_smtp_client: Optional[aiosmtplib.SMTP] = None
+_smtp_lock = asyncio.Lock()
+
+
+def _smtp_settings() -> Optional[Dict[str, object]]:
     host = os.getenv("SMTP_HOST")
     user = os.getenv("SMTP_USER")
     password = os.getenv("SMTP_PASSWORD")
+    if not host or not user or not password:
+        return None
+
+    try:
+        port = int(os.getenv("SMTP_PORT", "587"))
+    except ValueError:
+        port = 587
+
+    return {"host": host, "port": port, "user": user, "password": password}
+
+
+def send_email(subject: str, body: str, to_email: str) -> None:
+    """
+    Подготвя имейла и го слага в опашката – изпращането става от _email_worker,
+    така че заявката не чака SMTP.
+    """
+    host = os.getenv("SMTP_HOST")
+    user = os.getenv("SMTP_USER")
     port_str = os.getenv("SMTP_PORT", "587")
     from_email = os.getenv("SMTP_FROM") or user or to_email
 
-    logger.info(f"[EMAIL] Preparing email to {to_email} with subject '{subject}'")
-    logger.info(f"[EMAIL] SMTP_HOST={host}, SMTP_USER={user}, SMTP_PORT={port_str}")
+    logger.info("[EMAIL] Preparing email to %s with subject '%s'", to_email, subject)
+    logger.info("[EMAIL] SMTP_HOST=%s, SMTP_USER=%s, SMTP_PORT=%s", host, user, port_str)
 
-    if not host or not user or not password:
+    if _smtp_settings() is None:
         logger.warning("[EMAIL] Missing SMTP configuration, email will NOT be sent.")
         return
 
-    try:
-        port = int(port_str)
-    except ValueError:
-        port = 587
-
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = from_email
     msg["To"] = to_email
     msg.set_content(body)
 
+    _email_queue.put_nowait(msg)
+
+
+async def _get_smtp(settings: Dict[str, object]) -> Optional[aiosmtplib.SMTP]:
+    """
+    Връща отворена и логната SMTP връзка. Предишната връзка се преизползва,
+    ако отговаря на NOOP; иначе се отваря нова (connect + STARTTLS + login).
+    """
+    global _smtp_client
+    if _smtp_client is not None:
+        try:
+            await _smtp_client.noop()
+            return _smtp_client
+        except Exception:
+            await _close_smtp()
+
+    smtp = aiosmtplib.SMTP(
+        hostname=settings["host"],
+        port=settings["port"],
+        timeout=15,
+        start_tls=False,
+    )
     try:
-        with smtplib.SMTP(host, port, timeout=15) as server:
-            try:
-                server.starttls()
-                logger.info("[EMAIL] STARTTLS successful.")
-            except Exception as e:
-                logger.warning(f"[EMAIL] STARTTLS failed or not supported: {e}")
-            try:
-                server.login(user, password)
-                logger.info("[EMAIL] SMTP login successful.")
-            except Exception as e:
-                logger.error(f"[EMAIL] SMTP login failed: {e}")
-                return
+        await smtp.connect()
+    except Exception as e:
+        logger.error("[EMAIL] SMTP connection failed: %s", e)
+        return None
+
+    try:
+        await smtp.starttls()
+        logger.info("[EMAIL] STARTTLS successful.")
+    except Exception as e:
+        logger.warning("[EMAIL] STARTTLS failed or not supported: %s", e)
+    try:
+        await smtp.login(settings["user"], settings["password"])
+        logger.info("[EMAIL] SMTP login successful.")
+    except Exception as e:
+        logger.error("[EMAIL] SMTP login failed: %s", e)
+        smtp.close()
+        return None
+
+    _smtp_client = smtp
+    return smtp
+
+
+async def _close_smtp() -> None:
+    global _smtp_client
+    if _smtp_client is None:
+        return
+    try:
+        await _smtp_client.quit()
+    except Exception:
+        _smtp_client.close()
+    _smtp_client = None
+
+
+async def _send_email_batch(batch: List[EmailMessage]) -> None:
+    """
+    Изпраща група имейли през споделената SMTP връзка. Ако сървърът е затворил
+    връзката по средата, се свързваме отново и опитваме съобщението още веднъж.
+    """
+    settings = _smtp_settings()
+    if settings is None:
+        logger.warning("[EMAIL] Missing SMTP configuration, email will NOT be sent.")
+        return
+
+    async with _smtp_lock:
+        # NOOP проверката е веднъж за пакета. Ако връзката падне по средата,
+        # SMTPServerDisconnected я затваря и следващият опит се свързва наново без NOOP.
+        if await _get_smtp(settings) is None:
+            return
+        for msg in batch:
+            for attempt in (1, 2):
+                smtp = _smtp_client or await _get_smtp(settings)
+                if smtp is None:
+                    return
+                try:
+                    await smtp.send_message(msg)
+                    logger.info("[EMAIL] Email sent successfully.")
+                    break
+                except aiosmtplib.SMTPServerDisconnected as e:
+                    await _close_smtp()
+                    if attempt == 2:
+                        logger.error("[EMAIL] Sending email failed: %s", e)
+                except Exception as e:
+                    logger.error("[EMAIL] Sending email failed: %s", e)
+                    break
+
+
+async def _flush_email_queue(timeout: float = 30) -> None:
+    """
+    Изпраща останалите в опашката имейли (при спиране на приложението),
+    за да не се губят заявки, потвърдени вече на клиента.
+    """
+    batch: List[EmailMessage] = []
+    while not _email_queue.empty():
+        msg = _email_queue.get_nowait()
+        if msg is not None:
+            batch.append(msg)
+    if not batch:
+        return
+
+    try:
+        await asyncio.wait_for(_send_email_batch(batch), timeout)
+    except Exception as e:
+        logger.error("[EMAIL] Failed to flush %s queued email(s): %s", len(batch), e)
+
+
+async def _email_worker() -> None:
+    """
+    Фонова задача: взема всички чакащи имейли от опашката и ги изпраща наведнъж.
+    Спира след като изпрати пакета, в който е дошъл None (виж _stop_email_worker).
+    """
+    while True:
+        batch = [await _email_queue.get()]
+        while not _email_queue.empty():
+            batch.append(_email_queue.get_nowait())
+
+        stop = None in batch
+        batch = [msg for msg in batch if msg is not None]
+        if batch:
             try:
-                server.send_message(msg)
-                logger.info("[EMAIL] Email sent successfully.")
+                await _send_email_batch(batch)
             except Exception as e:
-                logger.error(f"[EMAIL] Sending email failed: {e}")
+                logger.error("[EMAIL] Email worker failed: %s", e)
+        if stop:
+            return
+
+
+async def _stop_email_worker(timeout: float = 30) -> None:
+    """
+    Спира worker-а без да прекъсва пакет, който вече изпраща: слага None в опашката
+    и изчаква задачата да приключи. Отказва се (cancel) чак след timeout секунди.
+    """
+    if _email_worker_task is None or _email_worker_task.done():
+        return
+    _email_queue.put_nowait(None)
+    try:
+        await asyncio.wait_for(_email_worker_task, timeout)
     except Exception as e:
-        logger.error(f"[EMAIL] SMTP connection failed: {e}")
+        logger.error("[EMAIL] Email worker did not stop cleanly: %s", e)
+
+
+# =========================
+# Логове на заявките
+# =========================
+
+# Записите са msgpack рамки с 4-байтова дължина отпред (little-endian); чете се с tail_log.py.
+APPOINTMENTS_LOG = "appointments.mpk"
+CONTACT_MESSAGES_LOG = "contact_messages.mpk"
+_FRAME_HEADER = struct.Struct("<I")
+LOG_FLUSH_INTERVAL = 0.05
+
+# (път до файла, рамка) – записват се от _log_flusher, за да не отваряме файла при всяка заявка.
+_log_queue: "asyncio.Queue[Tuple[str, bytes]]" = asyncio.Queue()
+_log_flusher_task: Optional[asyncio.Task] = None
+# Отворени веднъж O_APPEND дескриптори – всеки os.write се добавя атомарно в края на файла.
+_log_fds: Dict[str, int] = {}
+
+
+def append_log(path: str, record: Dict[str, object]) -> None:
+    buf = msgpack.packb(record, use_bin_type=True)
+    _log_queue.put_nowait((path, _FRAME_HEADER.pack(len(buf)) + buf))
+
+
+def _log_fd(path: str) -> int:
+    fd = _log_fds.get(path)
+    if fd is None:
+        fd = _log_fds[path] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    return fd
+
+
+def _write_log_batch(batch: List[Tuple[str, bytes]]) -> None:
+    frames_by_path: Dict[str, List[bytes]] = {}
+    for path, frame in batch:
+        frames_by_path.setdefault(path, []).append(frame)
+
+    for path, frames in frames_by_path.items():
+        fd = _log_fd(path)
+        view = memoryview(b"".join(frames))
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def _drain_log_queue() -> None:
+    batch: List[Tuple[str, bytes]] = []
+    while not _log_queue.empty():
+        batch.append(_log_queue.get_nowait())
+    if batch:
+        _write_log_batch(batch)
+
+
+async def _log_flusher(interval: float = LOG_FLUSH_INTERVAL) -> None:
+    """
+    Фонова задача: събира записите, натрупани за interval секунди, и ги записва
+    с по един os.write на файл през отворени веднъж файлови дескриптори.
+    """
+    while True:
+        batch = [await _log_queue.get()]
+        while not _log_queue.empty():
+            batch.append(_log_queue.get_nowait())
+
+        try:
+            _write_log_batch(batch)
+        except Exception as e:
+            logger.error("[LOG] Failed to write %s record(s): %s", len(batch), e)
+        await asyncio.sleep(interval)
+
+
+def _close_log_files() -> None:
+    try:
+        _drain_log_queue()
+    except Exception as e:
+        logger.error("[LOG] Failed to flush queued records: %s", e)
+    for fd in _log_fds.values():
+        os.close(fd)
+    _log_fds.clear()
 
 
 # =========================
@@ -1055,23 +1911,101 @@ def send_email(subject: str, body: str, to_email: str) -> None:
 
 app = FastAPI()
 
+
+def _cors_origins() -> List[str]:
+    """
+    Разрешени origins: CORS_ALLOW_ORIGINS (разделени със запетая)
+    или по подразбиране сайтовете от BUSINESSES (+ www вариант).
+    """
+    env_value = os.getenv("CORS_ALLOW_ORIGINS")
+    if env_value:
+        return [o.strip().rstrip("/") for o in env_value.split(",") if o.strip()]
+
+    origins: List[str] = []
+    for biz in BUSINESSES.values():
+        parsed = urlparse(biz.get("site_url") or "")
+        if not parsed.scheme or not parsed.netloc:
+            continue
+        origins.append(f"{parsed.scheme}://{parsed.netloc}")
+        if not parsed.netloc.startswith("www."):
+            origins.append(f"{parsed.scheme}://www.{parsed.netloc}")
+    return origins
+
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=_cors_origins(),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["POST", "GET", "OPTIONS"],
+    allow_headers=["content-type", "authorization", "x-business-id"],
+    max_age=86400,
 )
 
 
+MAX_MESSAGE_LENGTH = 8000
+MAX_HISTORY_MESSAGES = 10
+
+
 class ChatRequest(BaseModel):
-    message: str
-    business_id: Optional[str] = "vlt_data"
-    history: Optional[List[Dict[str, str]]] = None
+    # Непознатите полета от клиента се игнорират, без да се пазят в модела.
+    model_config = ConfigDict(extra="ignore")
 
+    message: str = Field(max_length=MAX_MESSAGE_LENGTH)
+    business_id: str = "vlt_data"
+    history: Optional[List[Dict[str, str]]] = None
 
-class ChatResponse(BaseModel):
-    reply: str
+    @field_validator("history", mode="before")
+    @classmethod
+    def _trim_history(cls, v):
+        # Валидираме само последните съобщения, останалите така или иначе не се ползват.
+        if not v:
+            return None
+        if isinstance(v, list):
+            return v[-MAX_HISTORY_MESSAGES:]
+        return v
+
+
+# Нишки за run_in_threadpool (контекст от сайта, токени за Google) вместо 40-те по подразбиране.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "16"))
+REPLY_TASKS_SHUTDOWN_TIMEOUT = 30  # секунди
+
+
+@app.on_event("startup")
+async def startup():
+    global _email_worker_task, _log_flusher_task
+    _start_log_listener()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    get_http_session()
+    # Подготвяме кешираните промптове, за да не ги строи първата заявка.
+    for business_id in BUSINESSES:
+        _system_message(business_id)
+        _site_context_prefix(business_id)
+    _email_worker_task = asyncio.create_task(_email_worker())
+    _log_flusher_task = asyncio.create_task(_log_flusher())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Първо довършваме четенето на отговори и записите – те добавят имейли и логове.
+    # Завършил _consume_reply пуска нови задачи за запис, затова чакаме, докато множеството
+    # се изпразни, но общо не повече от REPLY_TASKS_SHUTDOWN_TIMEOUT секунди.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REPLY_TASKS_SHUTDOWN_TIMEOUT
+    while _reply_tasks:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            logger.error("[CHAT] %s reply task(s) still pending at shutdown", len(_reply_tasks))
+            break
+        await asyncio.wait(set(_reply_tasks), timeout=remaining)
+    await _stop_email_worker()
+    if _log_flusher_task is not None:
+        _log_flusher_task.cancel()
+    _close_log_files()
+    await _flush_email_queue()
+    await _close_smtp()
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _stop_log_listener()
 
 
 @app.get("/health")
@@ -1079,330 +2013,340 @@ async def health():
     return {"status": "ok", "service": "ChatVLT"}
 
 
-def save_appointment(business_id: str, json_str: str) -> None:
+async def save_appointment(business_id: str, json_str: str) -> None:
     try:
-        m = re.search(r"\{.*\}", json_str, re.DOTALL)
-        if not m:
+        data = _decode_marker_json(json_str)
+        if data is None:
             return
-        data = json.loads(m.group(0))
 
         record = {
             "business_id": business_id,
-            "timestamp_utc": datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(),
+            "timestamp_utc": _utc_now_iso(),
             **data,
         }
 
-        with open("appointments.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        append_log(APPOINTMENTS_LOG, record)
 
         to_email = os.getenv("APPOINTMENT_EMAIL_TO")
-        logger.info(f"[APPOINTMENT] Saved appointment for business={business_id}, to_email={to_email}")
+        logger.info("[APPOINTMENT] Saved appointment for business=%s, to_email=%s", business_id, to_email)
 
-        lang = (data.get("language") or "").lower()
-        is_bg = lang.startswith("bg")
+        lang = _template_lang(data)
+        time_text = data.get("appointment_time_text")
+        # Полетата за шаблоните се събират веднъж – и двата имейла ползват едни и същи стойности.
+        fields = _template_fields(record, business_id=business_id)
 
         # -------- Имейл към фирмата --------
         if to_email:
-            if is_bg:
-                subject = f"Нова заявка за среща от ChatVLT ({business_id})"
-                body_lines = [
-                    "Имате нова заявка за среща от ChatVLT.",
-                    "",
-                    f"Име: {data.get('name') or ''}",
-                    f"Фирма: {data.get('company') or ''}",
-                    f"Email: {data.get('email') or ''}",
-                    f"Телефон: {data.get('phone') or ''}",
-                    f"Локация: {data.get('location') or ''}",
-                    "",
-                    "Описание на проекта / причина за среща:",
-                    data.get("project_description") or "",
-                    "",
-                ]
-            else:
-                subject = f"New appointment request from ChatVLT ({business_id})"
-                body_lines = [
-                    "You have a new appointment request from ChatVLT.",
-                    "",
-                    f"Name: {data.get('name') or ''}",
-                    f"Company: {data.get('company') or ''}",
-                    f"Email: {data.get('email') or ''}",
-                    f"Phone: {data.get('phone') or ''}",
-                    f"Location: {data.get('location') or ''}",
-                    "",
-                    "Project / appointment description:",
-                    data.get("project_description") or "",
-                    "",
-                ]
-
-            if data.get("appointment_time_text"):
-                body_lines.append(f"Requested time (human text): {data.get('appointment_time_text')}")
-            if data.get("appointment_time_utc"):
-                body_lines.append(f"Requested time (UTC ISO): {data.get('appointment_time_utc')}")
-
-            body_lines.extend(
-                [
-                    "",
-                    f"Език на клиента / Client language: {data.get('language') or ''}",
-                    f"Business ID: {business_id}",
-                    "",
-                    f"Време (UTC): {record['timestamp_utc']}",
-                ]
-            )
-
-            body = "\n".join(body_lines)
-            send_email(subject, body, to_email)
+            fields["requested_time"] = _requested_time_lines(time_text, data.get("appointment_time_utc"))
+            send_email(*_render_email(lang, "appt", "company", fields), to_email)
 
         # -------- Имейл потвърждение към клиента --------
         client_email = (data.get("email") or "").strip()
         if client_email:
-            if is_bg:
-                subject_c = "Потвърждение за заявка за среща с VLT DATA SOLUTIONS"
-                body_c_lines = [
-                    f"Здравейте, {data.get('name') or ''},",
-                    "",
-                    "Вашата заявка за среща е получена успешно.",
-                    "",
-                    "Обобщение:",
-                    f"- Име: {data.get('name') or ''}",
-                    f"- Фирма: {data.get('company') or ''}",
-                    f"- Локация: {data.get('location') or ''}",
-                    "",
-                    "Описание на проекта / причина за срещата:",
-                    data.get("project_description") or "",
-                    "",
-                ]
-                if data.get("appointment_time_text"):
-                    body_c_lines.append(f"Предпочитан час: {data.get('appointment_time_text')}")
-                body_c_lines.extend(
-                    [
-                        "",
-                        "Екипът на VLT DATA SOLUTIONS ще прегледа заявката и ще се свърже с вас за окончателно потвърждение на часа.",
-                        "",
-                        "Поздрави,",
-                        "VLT DATA SOLUTIONS",
-                    ]
-                )
-            else:
-                subject_c = "Appointment request received – VLT DATA SOLUTIONS"
-                body_c_lines = [
-                    f"Hello {data.get('name') or ''},",
-                    "",
-                    "Your appointment request has been received successfully.",
-                    "",
-                    "Summary:",
-                    f"- Name: {data.get('name') or ''}",
-                    f"- Company: {data.get('company') or ''}",
-                    f"- Location: {data.get('location') or ''}",
-                    "",
-                    "Project / appointment description:",
-                    data.get("project_description") or "",
-                    "",
-                ]
-                if data.get("appointment_time_text"):
-                    body_c_lines.append(f"Preferred time: {data.get('appointment_time_text')}")
-                body_c_lines.extend(
-                    [
-                        "",
-                        "The VLT DATA SOLUTIONS team will review your request and contact you to confirm the exact time.",
-                        "",
-                        "Best regards,",
-                        "VLT DATA SOLUTIONS",
-                    ]
-                )
-
-            body_c = "\n".join(body_c_lines)
-            send_email(subject_c, body_c, client_email)
+            fields["preferred_time"] = f"{_PREFERRED_TIME_LABELS[lang]}: {time_text}\n" if time_text else ""
+            send_email(*_render_email(lang, "appt", "client", fields), client_email)
 
         # -------- Събитие в календара --------
-        create_calendar_event_from_appointment(record)
+        await create_calendar_event_from_appointment(record)
 
     except Exception as e:
-        logger.error(f"[APPOINTMENT] Error while saving/sending appointment: {e}")
+        logger.error("[APPOINTMENT] Error while saving/sending appointment: %s", e)
 
 
-def save_contact_message(business_id: str, json_str: str) -> None:
+async def save_contact_message(business_id: str, json_str: str) -> None:
     try:
-        m = re.search(r"\{.*\}", json_str, re.DOTALL)
-        if not m:
+        data = _decode_marker_json(json_str)
+        if data is None:
             return
-        data = json.loads(m.group(0))
 
         record = {
             "business_id": business_id,
-            "timestamp_utc": datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(),
+            "timestamp_utc": _utc_now_iso(),
             **data,
         }
 
-        with open("contact_messages.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        append_log(CONTACT_MESSAGES_LOG, record)
 
         to_email = os.getenv("CONTACT_EMAIL_TO")
-        logger.info(f"[CONTACT] Saved contact message for business={business_id}, to_email={to_email}")
+        logger.info("[CONTACT] Saved contact message for business=%s, to_email=%s", business_id, to_email)
 
         if to_email:
-            lang = (data.get("language") or "").lower()
-            is_bg = lang.startswith("bg")
-
-            if is_bg:
-                subject = f"Ново съобщение от ChatVLT ({business_id})"
-                body_lines = [
-                    "Имате ново контактно съобщение от ChatVLT.",
-                    "",
-                    f"Име: {data.get('name') or ''}",
-                    f"Email: {data.get('email') or ''}",
-                    f"Телефон: {data.get('phone') or ''}",
-                    "",
-                    f"Тема: {data.get('subject') or ''}",
-                    "",
-                    "Съобщение:",
-                    data.get("message") or "",
-                    "",
-                    f"Език на клиента: {data.get('language') or ''}",
-                    f"Business ID: {business_id}",
-                    "",
-                    f"Време (UTC): {record['timestamp_utc']}",
-                ]
-            else:
-                subject = f"New contact message from ChatVLT ({business_id})"
-                body_lines = [
-                    "You have a new contact message from ChatVLT.",
-                    "",
-                    f"Name: {data.get('name') or ''}",
-                    f"Email: {data.get('email') or ''}",
-                    f"Phone: {data.get('phone') or ''}",
-                    "",
-                    f"Subject: {data.get('subject') or ''}",
-                    "",
-                    "Message:",
-                    data.get("message") or "",
-                    "",
-                    f"Client language: {data.get('language') or ''}",
-                    f"Business ID: {business_id}",
-                    "",
-                    f"Time (UTC): {record['timestamp_utc']}",
-                ]
-
-            body = "\n".join(body_lines)
-            send_email(subject, body, to_email)
+            fields = _template_fields(record, business_id=business_id)
+            send_email(*_render_email(_template_lang(data), "contact", "company", fields), to_email)
 
     except Exception as e:
-        logger.error(f"[CONTACT] Error while saving/sending contact message: {e}")
+        logger.error("[CONTACT] Error while saving/sending contact message: %s", e)
 
 
 def build_search_url(business_id: str, json_str: str) -> Optional[str]:
     try:
-        m = re.search(r"\{.*\}", json_str, re.DOTALL)
-        if not m:
+        data = _decode_marker_json(json_str)
+        if data is None:
             return None
-        data = json.loads(m.group(0))
 
         query = data.get("query", "")
         if not query:
             return None
 
-        biz = BUSINESSES.get(business_id, BUSINESSES["vlt_data"])
+        biz = _biz(business_id)
         template = biz.get("search_url_template")
         if not template:
             return None
 
-        from urllib.parse import quote_plus
-
         encoded_query = quote_plus(query)
         return template.format(query=encoded_query)
     except Exception as e:
-        logger.error(f"[SEARCH] Error while building search URL: {e}")
+        logger.error("[SEARCH] Error while building search URL: %s", e)
         return None
 
 
+# Без тях nginx и подобни proxy-та буферират отговора и потребителят пак чака целия текст.
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _sse(payload: Dict[str, object]) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _visible_length(text: str) -> int:
+    """
+    Колко символа от text могат да се изпратят към клиента, без да покажем маркер
+    или началото на маркер, който още не е пристигнал изцяло.
+    """
+    m = _MARK_RE.search(text)
+    if m:
+        return m.start()
+
+    for k in range(min(len(text), _MAX_MARKER_LEN - 1), 0, -1):
+        tail = text[-k:]
+        if any(marker.startswith(tail) for marker in _MARKERS):
+            return len(text) - k
+    return len(text)
+
+
+# Задачи, които трябва да завършат и без клиента (четене на отговора, записи);
+# пазим референции, за да не ги събере GC, и ги изчакваме при спиране.
+_reply_tasks: "set[asyncio.Task]" = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _reply_tasks.add(task)
+    task.add_done_callback(_reply_tasks.discard)
+    return task
+
+
+def _handle_reply_markers(business_id: str, raw_reply: str) -> str:
+    """
+    Обработва маркерите в пълния отговор (среща, контакт, търсене)
+    и връща текст, който да се добави към вече изпратения отговор.
+    Записът на среща/контакт (лог, имейли, календар) тече като отделна задача.
+    Данните за всеки маркер са текстът до следващия маркер; повторен маркер се пропуска.
+    """
+    extra = ""
+    matches = list(_MARK_RE.finditer(raw_reply))
+    handled = set()
+
+    for i, m in enumerate(matches):
+        marker = m.group()
+        if marker in handled:
+            continue
+        handled.add(marker)
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(raw_reply)
+        payload = raw_reply[m.end():end].strip()
+
+        if marker == APPOINTMENT_MARKER:
+            _spawn(save_appointment(business_id, payload))
+        elif marker == CONTACT_MARKER:
+            _spawn(save_contact_message(business_id, payload))
+        else:
+            url = build_search_url(business_id, payload)
+            if url:
+                extra = f"\n\n👉 Линк: {url}"
+
+    return extra
+
+
+async def _consume_reply(business_id: str, stream, frames: "asyncio.Queue[Optional[Dict[str, object]]]") -> None:
+    """
+    Чете стрийма от OpenAI до края, слага видимите части в frames и накрая
+    обработва маркерите. None в опашката означава край на отговора.
+    """
+    buffer = ""
+    sent = 0
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            buffer += delta
+            visible = _visible_length(buffer)
+            if visible > sent:
+                frames.put_nowait({"delta": buffer[sent:visible]})
+                sent = visible
+
+        # Опашката може да е задържана само защото прилича на начало на маркер ("C#");
+        # ако маркер така и не дойде, тя е част от видимия текст.
+        if sent < len(buffer) and not _MARK_RE.search(buffer):
+            frames.put_nowait({"delta": buffer[sent:]})
+    except Exception as e:
+        logger.error("[CHAT] Error while streaming response: %s", e)
+        frames.put_nowait({"error": "Error while generating response from ChatVLT."})
+        frames.put_nowait(None)
+        return
+
+    try:
+        extra = _handle_reply_markers(business_id, buffer.strip())
+        if extra:
+            frames.put_nowait({"delta": extra})
+        frames.put_nowait({"done": True})
+    finally:
+        # Винаги затваряме потока към клиента, дори ако обработката на маркерите гръмне.
+        frames.put_nowait(None)
+
+
 # =========================
 # /chat endpoint
 # =========================
 
-@app.post("/chat", response_model=ChatResponse)
+MAX_PROMPT_BYTES = 32_000
+MAX_HISTORY_CONTENT_CHARS = 4000
+_ROLES = frozenset(("user", "assistant"))
+
+
+def _utf8_len(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+@lru_cache(maxsize=16)
+def _system_message(business_id: str) -> Tuple[Dict[str, str], int]:
+    """
+    Готовото системно съобщение и размерът му в байтове. Речникът е общ за всички
+    заявки на бизнеса – само се чете при изпращането към OpenAI.
+    """
+    prompt = build_system_prompt(business_id)
+    return {"role": "system", "content": prompt}, _utf8_len(prompt)
+
+
+def _build_messages(
+    business_id: str,
+    history: List[Dict[str, str]],
+    extra_system: List[str],
+    site_context: Optional[str],
+    user_message: str,
+) -> List[Dict[str, str]]:
+    """
+    Сглобява съобщенията към модела в рамките на MAX_PROMPT_BYTES: първо отпадат
+    най-старите реплики от историята, после се съкращава контекстът от сайта.
+    Системният промпт, наличността и въпросът на потребителя не се пипат.
+    """
+    system_message, total = _system_message(business_id)
+    total += _utf8_len(user_message) + sum(map(_utf8_len, extra_system))
+    history_sizes = [_utf8_len(m["content"]) for m in history]
+    total += sum(history_sizes)
+    if site_context:
+        total += _utf8_len(site_context)
+
+    dropped = 0
+    while total > MAX_PROMPT_BYTES and dropped < len(history):
+        total -= history_sizes[dropped]
+        dropped += 1
+
+    truncated = 0
+    if total > MAX_PROMPT_BYTES and site_context:
+        encoded = site_context.encode("utf-8")
+        keep = max(len(encoded) - (total - MAX_PROMPT_BYTES), 0)
+        site_context = encoded[:keep].decode("utf-8", "ignore")
+        truncated = len(encoded) - keep
+
+    if dropped or truncated:
+        logger.info(
+            "[CHAT] Prompt over %s bytes: dropped %s history message(s), cut %s byte(s) of site context",
+            MAX_PROMPT_BYTES, dropped, truncated,
+        )
+
+    messages = [system_message]
+    messages.extend(history[dropped:])
+    messages.extend({"role": "system", "content": text} for text in extra_system)
+    if site_context:
+        messages.append({"role": "system", "content": site_context})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+AVAILABILITY_KEYWORDS = (
+    "свободни часове",
+    "свободни слотове",
+    "кога има свободни",
+    "кога имате свободни",
+    "час за среща",
+    "запазя час",
+    "запиша час",
+    "запис за среща",
+    "искам час",
+    "искам среща",
+    "book an appointment",
+    "schedule a meeting",
+    "available time",
+    "available times",
+    "free slots",
+    "free time for meeting",
+)
+# Една алтернация вместо отделно търсене за всяка ключова дума.
+_AVAIL_RE = re.compile("|".join(map(re.escape, AVAILABILITY_KEYWORDS)), re.IGNORECASE)
+
+
+@app.post("/chat")
 async def chat(req: ChatRequest):
     if not req.message or not req.message.strip():
         raise HTTPException(status_code=400, detail="Empty message.")
 
     business_id = req.business_id or "vlt_data"
-    system_prompt = build_system_prompt(business_id)
-
-    messages = [{"role": "system", "content": system_prompt}]
+    history = [
+        {"role": role, "content": content[:MAX_HISTORY_CONTENT_CHARS]}
+        for m in req.history or ()
+        if (role := m.get("role")) in _ROLES and (content := m.get("content"))
+    ]
 
-    if req.history:
-        for m in req.history[-10:]:
-            role = m.get("role")
-            content = m.get("content", "")
-            if role in ("user", "assistant") and content:
-                messages.append({"role": role, "content": content})
+    extra_system: List[str] = []
 
     # 🔹 Свободни часове – когато потребителят иска среща или пита за availability
-    msg_lower = req.message.lower()
-    availability_keywords = [
-        "свободни часове",
-        "свободни слотове",
-        "кога има свободни",
-        "кога имате свободни",
-        "час за среща",
-        "запазя час",
-        "запиша час",
-        "запис за среща",
-        "искам час",
-        "искам среща",
-        "book an appointment",
-        "schedule a meeting",
-        "available time",
-        "available times",
-        "free slots",
-        "free time for meeting",
-    ]
-    if any(k in msg_lower for k in availability_keywords):
-        avail_text = get_free_windows_text(days=5)
+    if _AVAIL_RE.search(req.message):
+        avail_text = await get_free_windows_text(days=5)
         if avail_text:
-            messages.append(
-                {
-                    "role": "system",
-                    "content": avail_text,
-                }
-            )
+            extra_system.append(avail_text)
 
-    site_context = build_site_context_message(business_id, req.message)
-    if site_context:
-        messages.append({"role": "system", "content": site_context})
+    # Embedding-ът на заявката (и евентуално обхождане на сайта) са блокиращи – пускаме ги в нишка.
+    site_context = await run_in_threadpool(build_site_context_message, business_id, req.message)
 
-    messages.append({"role": "user", "content": req.message})
+    messages = _build_messages(business_id, history, extra_system, site_context, req.message)
 
     try:
-        completion = client.chat.completions.create(
+        stream = await async_client.chat.completions.create(
             model="gpt-4.1-mini",
             messages=messages,
             max_tokens=700,
+            stream=True,
         )
-
-        raw_reply = completion.choices[0].message.content.strip()
-        visible_reply = raw_reply
-
-        if APPOINTMENT_MARKER in visible_reply:
-            before, after = visible_reply.split(APPOINTMENT_MARKER, 1)
-            visible_reply = before.strip()
-            save_appointment(business_id, after.strip())
-
-        if CONTACT_MARKER in visible_reply:
-            before, after = visible_reply.split(CONTACT_MARKER, 1)
-            visible_reply = before.strip()
-            save_contact_message(business_id, after.strip())
-
-        if SEARCH_MARKER in visible_reply:
-            before, after = visible_reply.split(SEARCH_MARKER, 1)
-            visible_reply = before.strip()
-            url = build_search_url(business_id, after.strip())
-            if url:
-                visible_reply = f"{visible_reply}\n\n👉 Линк: {url}"
-
-        return ChatResponse(reply=visible_reply)
-
     except Exception as e:
-        logger.error(f"[CHAT] Error while generating response: {e}")
+        logger.error("[CHAT] Error while generating response: %s", e)
         raise HTTPException(
             status_code=500,
             detail="Error while generating response from ChatVLT.",
         )
+
+    # Отговорът се чете в отделна задача: ако клиентът затвори страницата преди края,
+    # генераторът се прекратява, но маркерите (JSON-ът идва последен) пак се обработват.
+    frames: "asyncio.Queue[Optional[Dict[str, object]]]" = asyncio.Queue()
+    _spawn(_consume_reply(business_id, stream, frames))
+
+    async def event_stream():
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                return
+            yield _sse(frame)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=_SSE_HEADERS)
@@ -0,0 +1,69 @@
+"""
+Показва последните записи от appointments.mpk / contact_messages.mpk като JSON редове.
+
+    python tail_log.py appointments.mpk -n 20
+    python tail_log.py contact_messages.mpk -f
+"""
+import argparse
+import json
+import struct
+import sys
+import time
+from collections import deque
+from typing import BinaryIO, Dict, Iterator
+
+import msgpack
+
+_FRAME_HEADER = struct.Struct("<I")
+
+
+def read_frames(f: BinaryIO) -> Iterator[Dict[str, object]]:
+    """
+    Чете рамките до края на файла. Непълна последна рамка (записът още не е
+    довършен) се оставя за следващото четене.
+    """
+    while True:
+        start = f.tell()
+        header = f.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            f.seek(start)
+            return
+        (length,) = _FRAME_HEADER.unpack(header)
+        buf = f.read(length)
+        if len(buf) < length:
+            f.seek(start)
+            return
+        yield msgpack.unpackb(buf, raw=False)
+
+
+def _print(record: Dict[str, object]) -> None:
+    print(json.dumps(record, ensure_ascii=False), flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Print ChatVLT msgpack log records as JSON lines.")
+    parser.add_argument("path")
+    parser.add_argument("-n", "--lines", type=int, default=10, help="how many of the last records to show")
+    parser.add_argument("-f", "--follow", action="store_true", help="keep waiting for new records")
+    args = parser.parse_args()
+
+    try:
+        f = open(args.path, "rb")
+    except OSError as e:
+        sys.exit(f"Cannot open {args.path}: {e}")
+
+    with f:
+        for record in deque(read_frames(f), maxlen=max(args.lines, 0)):
+            _print(record)
+
+        while args.follow:
+            time.sleep(0.5)
+            for record in read_frames(f):
+                _print(record)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass